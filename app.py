@@ -1,8 +1,13 @@
+import hmac
+import re
+import time
 import streamlit as st
 import gspread
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, date, timezone, timedelta
-from collections import Counter
 
 st.set_page_config(
     page_title="文化祭ポテト会計",
@@ -24,11 +29,22 @@ def today_jst():
 BASE_PRICE = 300  # 通常価格
 SEMINAR_PRICE = 200 # 講演会価格
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+HEADER = ["timestamp", "date", "count", "amount", "detail"]
+SUM_RANGE = "F1:G1"  # 売上個数・売上金額の合計（数式）を置くセル
+# 列全体を足す（ヘッダーは文字列なので SUM に無視される）。
+# C2:C のように始まりを決めると、2 行目に行を挿入したときに C3:C へずれる
+SUM_FORMULAS = [["=SUM(C:C)", "=SUM(D:D)"]]
+DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")  # 日付シート名の形
+FLUSH_BATCH = 10  # まとめて保存モードで、この件数たまったらシートに書き込む
 
 # ===== Streamlit Secrets から設定を読み込む =====
-SERVICE_ACCOUNT_INFO = st.secrets["google_service_account"]
-SPREADSHEET_ID = SERVICE_ACCOUNT_INFO["SPREADSHEET_ID"]
-DISCOUNT_PASSWORD = SERVICE_ACCOUNT_INFO["DISCOUNT_PASSWORD"]
+@st.cache_resource
+def load_secrets():
+    """
+    (サービスアカウント情報, SPREADSHEET_ID, DISCOUNT_PASSWORD) を返す
+    """
+    info = st.secrets["google_service_account"]
+    return info, info["SPREADSHEET_ID"], info["DISCOUNT_PASSWORD"]
 
 
 @st.cache_resource
@@ -36,145 +52,493 @@ def get_gsheet_client():
     """
     Google Sheets クライアント（Cloud 専用）
     """
+    service_account_info, _, _ = load_secrets()
     creds = Credentials.from_service_account_info(
-        SERVICE_ACCOUNT_INFO,
+        service_account_info,
         scopes=SCOPES
     )
-    client = gspread.authorize(creds)
+    # 接続を使い回して、Sheets への呼び出しごとの TLS ハンドシェイクを省く
+    session = AuthorizedSession(creds)
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=[429, 500, 502, 503, 504],
+                # 使い切ったら最後のレスポンスを返し、gspread に APIError を出させる
+                raise_on_status=False,
+            ),
+        ),
+    )
+    client = gspread.Client(auth=creds, session=session)
     return client
 
 
+@st.cache_resource
+def get_spreadsheet():
+    """
+    スプレッドシート本体（open_by_key の結果を使い回す）
+    """
+    _, spreadsheet_id, _ = load_secrets()
+    return get_gsheet_client().open_by_key(spreadsheet_id)
+
+
+def write_sum_formulas(ws):
+    """
+    F1:G1 に合計の数式を書き込む（集計は Google 側でやってもらう）
+    """
+    if ws.col_count < 7:
+        ws.add_cols(7 - ws.col_count)
+    ws.update(
+        values=SUM_FORMULAS,
+        range_name=SUM_RANGE,
+        value_input_option="USER_ENTERED",  # 数式なのでここだけは解釈させる
+    )
+
+
+def parse_sum_cells(rows):
+    """
+    F1:G1 の値を (個数, 金額) にする。数式が入っていなければ None
+    """
+    try:
+        return int(rows[0][0]), int(rows[0][1])
+    except (ValueError, IndexError, TypeError):
+        return None
+
+
+def add_sheet_request(sheet_name, sheet_id=None):
+    """
+    日付シートを追加する addSheet リクエスト（sheet_id を省くと Google が決める）
+    """
+    props = {
+        "title": sheet_name,
+        "gridProperties": {"rowCount": 1000, "columnCount": 7},
+    }
+    if sheet_id is not None:
+        props["sheetId"] = sheet_id
+    return {"addSheet": {"properties": props}}
+
+
+def header_request(sheet_id):
+    """
+    ヘッダーと合計の数式を 1 行目に書き込む updateCells リクエスト
+    """
+    cells = [{"userEnteredValue": {"stringValue": h}} for h in HEADER]
+    cells += [{"userEnteredValue": {"formulaValue": f}} for f in SUM_FORMULAS[0]]
+    return {
+        "updateCells": {
+            "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+            "rows": [{"values": cells}],
+            "fields": "userEnteredValue",
+        }
+    }
+
+
+def create_day_sheet(sh, sheet_name):
+    """
+    日付シートを作り、ヘッダーと合計の数式を入れる。
+    シート追加とセルの書き込みを 1 回の batchUpdate で済ませる
+    """
+    # sheetId を自分で決めておけば、同じリクエスト内で書き込める
+    sheet_id = int(sheet_name.replace("-", ""))
+    body = {
+        "requests": [
+            add_sheet_request(sheet_name, sheet_id),
+            header_request(sheet_id),
+        ]
+    }
+    try:
+        res = sh.batch_update(body)
+    except gspread.exceptions.APIError as e:
+        msg = str(e.error.get("message", "")).lower()
+        if e.response.status_code != 400 or "already exists" not in msg:
+            raise
+        try:
+            # 別の端末が先に同じ名前のシートを作っていた
+            return sh.worksheet(sheet_name)
+        except gspread.exceptions.WorksheetNotFound:
+            pass
+        # 名前ではなく sheetId がほかのシート（日付シートのコピーなど）とかぶった：
+        # ID は Google に決めてもらい、追加と書き込みを 2 回に分ける
+        res = sh.batch_update({"requests": [add_sheet_request(sheet_name)]})
+        sheet_id = res["replies"][0]["addSheet"]["properties"]["sheetId"]
+        sh.batch_update({"requests": [header_request(sheet_id)]})
+    props = res["replies"][0]["addSheet"]["properties"]
+    # シート一覧のキャッシュ（全セッション共通）を作り直させる
+    date_sheet_titles.clear()
+    return gspread.Worksheet(sh, props, sh.id, sh.client)
+
+
 def get_today_worksheet():
-    client = get_gsheet_client()
-    sh = client.open_by_key(SPREADSHEET_ID)
-    sheet_name = today_jst().isoformat()
-  # "2025-11-21" みたいな形式
+    """
+    今日のシートを返す。日付が変わるまではセッションに保持したものを使う
+    """
+    sheet_name = today_jst().isoformat()  # "2025-11-21" みたいな形式
+    if st.session_state.get("ws_today_date") == sheet_name:
+        return st.session_state["ws_today"]
 
+    # 日付が変わった：未送信の会計は前日のシートに書き出しておく
+    if "ws_today" in st.session_state:
+        flush_pending_rows(st.session_state["ws_today"])
+
+    sh = get_spreadsheet()
     try:
         ws = sh.worksheet(sheet_name)
+        # 取り消し用に行数（ヘッダー込み）を覚えておく
+        rowcount = len(ws.col_values(1))
     except gspread.exceptions.WorksheetNotFound:
         # なければ新規作成してヘッダー行を入れる
-        ws = sh.add_worksheet(title=sheet_name, rows="1000", cols="5")
-        ws.append_row(["timestamp", "date", "count", "amount", "detail"])
+        ws = create_day_sheet(sh, sheet_name)
+        rowcount = 1
+
+    st.session_state["today_rowcount"] = rowcount
+    st.session_state["ws_today"] = ws
+    st.session_state["ws_today_date"] = sheet_name
     return ws
 
 
+# ===== 未送信の会計（まとめて保存モード） =====
+def flush_pending_rows(ws=None):
+    """
+    たまっている会計を append_rows で 1 回にまとめて書き込む
+    """
+    if ws is None:
+        # 日付が変わっていればここで前日分が書き出されるので、
+        # pending_rows はそのあとで読む
+        ws = get_today_worksheet()
+    rows = st.session_state.get("pending_rows")
+    if not rows:
+        return 0
+    ws.append_rows(
+        rows, value_input_option="RAW", insert_data_option="INSERT_ROWS"
+    )
+    n = len(rows)
+    st.session_state.today_rowcount += n
+    st.session_state.pending_rows = []
+    bump_stats_version()
+    return n
+
+
+def pending_stats():
+    """
+    未送信の会計の (個数, 金額)
+    """
+    return sum_count_amount(
+        [row[2:4] for row in st.session_state.get("pending_rows", [])]
+    )
+
+
 # ===== 売上集計 =====
+STATS_TTL = 30  # 集計結果をキャッシュする秒数
+SHEET_LIST_TTL = 300  # シート一覧をキャッシュする秒数
+SIDEBAR_REFRESH_SEC = 60  # サイドバーの売上表示を取り直す間隔
+PERIOD_DAYS = 5  # 「期間中合計」に含める日数
+
+
+def bump_stats_version():
+    """会計の追加・取り消し後に呼び、集計キャッシュを無効にする"""
+    # st.cache_data はプロセス全体で共有なので、ほかのセッションの分もまとめて消す
+    _today_stats_cached.clear()
+    _last_n_days_stats_cached.clear()
+    st.session_state.stats_version = st.session_state.get("stats_version", 0) + 1
+
+
 def get_today_stats():
     ws = get_today_worksheet()
-    values = ws.get_all_values()
-    if len(values) <= 1:
-        # ヘッダーしかない
-        return 0, 0
+    version = st.session_state.get("stats_version", 0)
+    fresh = st.session_state.get("today_sums")
+    if (
+        fresh is not None
+        and fresh["version"] == version
+        and time.time() - fresh["ts"] <= STATS_TTL
+    ):
+        # 取り消しのレスポンスで受け取った合計をそのまま使う
+        c, a = fresh["sums"]
+    else:
+        c, a = _today_stats_cached(today_jst().isoformat(), ws)
+    # 未送信分も足して画面の表示とずれないようにする
+    pc, pa = pending_stats()
+    return c + pc, a + pa
+
+
+@st.cache_data(ttl=STATS_TTL, show_spinner=False)
+def _today_stats_cached(day, _ws):
+    """
+    day をキーにキャッシュする（_ws はキーに含めない）。
+    会計の追加・取り消しのたびに bump_stats_version() で消される
+    """
+    sums = parse_sum_cells(
+        _ws.get(SUM_RANGE, value_render_option="UNFORMATTED_VALUE")
+    )
+    if sums is None:
+        # 数式セルがない古いシート：ここで書き込んで読み直す
+        write_sum_formulas(_ws)
+        sums = parse_sum_cells(
+            _ws.get(SUM_RANGE, value_render_option="UNFORMATTED_VALUE")
+        )
+    return sums or (0, 0)
+
 
+def sum_count_amount(rows):
+    """
+    [[count, amount], ...] の行を合計して (個数, 金額) を返す
+    """
     total_count = 0
     total_amount = 0
-    for row in values[1:]:
+    for row in rows:
         try:
-            c = int(row[2])  # count
-            a = int(row[3])  # amount
+            c = int(row[0])
+            a = int(row[1])
             total_count += c
             total_amount += a
         except (ValueError, IndexError):
             continue
     return total_count, total_amount
 
+
+def is_iso_date(title):
+    """
+    "2025-11-21" みたいな日付形式のシート名かどうか
+    """
+    # 形が違うものは例外を出させずに弾く
+    if not DATE_RE.match(title):
+        return False
+    try:
+        date.fromisoformat(title)
+        return True
+    except ValueError:
+        return False
+
+
+@st.cache_data(ttl=SHEET_LIST_TTL, show_spinner=False)
+def date_sheet_titles(day):
+    """
+    日付形式のシート名を古い順に並べて返す
+    （day はキャッシュ無効化用。シートを作ったときは create_day_sheet で消す）
+    """
+    # 日付じゃないシートは無視
+    titles = [ws.title for ws in get_spreadsheet().worksheets()]
+    return sorted(t for t in titles if is_iso_date(t))
+
+
 def get_last_n_days_stats(n=3):
     """
     直近 n 日分（シート名が YYYY-MM-DD のもの）の
     売上個数・売上金額の合計を返す
     """
-    client = get_gsheet_client()
-    sh = client.open_by_key(SPREADSHEET_ID)
+    titles = date_sheet_titles(today_jst().isoformat())
+    if not titles:
+        return 0, 0, None, None
 
-    date_sheets = []
-    for ws in sh.worksheets():
-        title = ws.title
-        try:
-            d = date.fromisoformat(title)  # "2025-11-21" みたいなシートだけ対象
-            date_sheets.append((d, ws))
-        except ValueError:
-            # 日付じゃないシートは無視
-            continue
+    # 直近 n 日を取る
+    last = tuple(titles[-n:])
+    c, a = _last_n_days_stats_cached(last, today_jst().isoformat())
+    # 未送信分も足す
+    pc, pa = pending_stats()
+    return c + pc, a + pa, last[0], last[-1]
 
-    if not date_sheets:
-        return 0, 0, None, None
 
-    # 日付でソートして直近 n 日を取る
-    date_sheets.sort(key=lambda x: x[0])
-    last = date_sheets[-n:]
+@st.cache_data(ttl=STATS_TTL, show_spinner=False)
+def _last_n_days_stats_cached(titles, day):
+    sh = get_spreadsheet()
+
+    # 各シートの C:D 列（個数・金額）を 1 回のリクエストでまとめて取得
+    # 合計セルのない古いシートも数えられるように、明細を手元で足す
+    res = sh.values_batch_get(
+        [f"'{title}'!C2:D" for title in titles],
+        params={"majorDimension": "ROWS"},
+    )
 
     total_count = 0
     total_amount = 0
+    for vr in res.get("valueRanges", []):
+        c, a = sum_count_amount(vr.get("values", []))
+        total_count += c
+        total_amount += a
+
+    return total_count, total_amount
+
+
+def get_sidebar_stats():
+    """
+    サイドバー用の (本日の集計, 期間中の集計) を返す。
+    会計の追加・取り消しがなく、前回から SIDEBAR_REFRESH_SEC 以内なら
+    前回の値をそのまま使う
+    """
+    key = (
+        st.session_state.get("stats_version", 0),
+        len(st.session_state.get("pending_rows", [])),
+    )
+    cache = st.session_state.get("stats_cache")
+    if (
+        cache is None
+        or cache["key"] != key
+        or time.time() - cache["ts"] > SIDEBAR_REFRESH_SEC
+    ):
+        cache = {
+            "today": get_today_stats(),
+            "range": get_last_n_days_stats(PERIOD_DAYS),
+            "ts": time.time(),
+            "key": key,
+        }
+        st.session_state.stats_cache = cache
+    return cache["today"], cache["range"]
+
+
+def resolve_last_row(ws):
+    """
+    取り消し対象の最終行を返す。覚えている行数は他の端末・タブの
+    書き込みでずれるので、シート上で本当に最後の行か確かめてから使う
+    """
+    n = st.session_state.today_rowcount
+    # n 行目に値があり、n+1 行目が空なら n が最終行
+    vals = ws.get(f"A{n}:A{n + 1}")
+    if not (len(vals) == 1 and vals[0]):
+        # ずれていたら A 列から数え直す
+        n = len(ws.col_values(1))
+    st.session_state.today_rowcount = n
+    return n
+
+
+# ===== 画面全体の再実行をまたぐメッセージ =====
+def flash(kind, msg):
+    """
+    st.rerun() のあとに表示するメッセージを積む（kind は "success" など）
+    """
+    st.session_state.setdefault("flash", []).append((kind, msg))
 
-    for _, ws in last:
-        values = ws.get_all_values()
-        if len(values) <= 1:
-            continue
-        for row in values[1:]:
-            try:
-                c = int(row[2])
-                a = int(row[3])
-                total_count += c
-                total_amount += a
-            except (ValueError, IndexError):
-                continue
 
-    start_date = last[0][0].isoformat()
-    end_date = last[-1][0].isoformat()
+def show_flash():
+    for kind, msg in st.session_state.pop("flash", []):
+        getattr(st, kind)(msg)
 
-    return total_count, total_amount, start_date, end_date
 
 # ===== 直前の会計を取り消し =====
 def cancel_last_transaction():
+    """
+    取り消せたら True を返す
+    """
+    # 未送信の会計があれば、シートには触らずそれを取り消す
+    if st.session_state.get("pending_rows"):
+        st.session_state.pending_rows.pop()
+        flash("success", "直前の会計を取り消しました。")
+        return True
+
     ws = get_today_worksheet()
-    values = ws.get_all_values()
-    if len(values) <= 1:
+    last_row = resolve_last_row(ws)
+    if last_row <= 1:
         st.warning("まだ会計データがありません。")
-        return
-    last_row = len(values)
-    ws.delete_rows(last_row)
-    st.success("直前の会計を取り消しました。")
+        return False
+    body = {
+        "requests": [
+            {
+                "deleteDimension": {
+                    "range": {
+                        "sheetId": ws.id,
+                        "dimension": "ROWS",
+                        "startIndex": last_row - 1,
+                        "endIndex": last_row,
+                    }
+                }
+            }
+        ],
+        # 削除後の合計セルも同じリクエストで返してもらう
+        "includeSpreadsheetInResponse": True,
+        "responseRanges": [f"'{ws.title}'!{SUM_RANGE}"],
+        "responseIncludeGridData": True,
+    }
+    res = get_spreadsheet().batch_update(body)
+    st.session_state.today_rowcount -= 1
+    bump_stats_version()
+
+    sums = parse_grid_sums(res)
+    if sums is not None:
+        st.session_state.today_sums = {
+            "version": st.session_state.stats_version,
+            "sums": sums,
+            "ts": time.time(),
+        }
+    flash("success", "直前の会計を取り消しました。")
+    return True
+
+
+def parse_grid_sums(res):
+    """
+    batchUpdate のレスポンス（updatedSpreadsheet）から F1:G1 の合計を取り出す
+    """
+    try:
+        sheet = res["updatedSpreadsheet"]["sheets"][0]
+        cells = sheet["data"][0]["rowData"][0]["values"][:2]
+        values = [c["effectiveValue"]["numberValue"] for c in cells]
+    except (KeyError, IndexError):
+        return None
+    return parse_sum_cells([values])
+
+
+# ===== カゴの操作 =====
+def add_to_basket(price):
+    """
+    カゴに 1 個追加し、集計（価格ごとの個数・合計）も差分だけ更新する
+    """
+    counter = st.session_state.basket_counter
+    counter[price] = counter.get(price, 0) + 1
+    st.session_state.basket_sum += price
+    st.session_state.basket_count += 1
+
+
+def reset_basket():
+    st.session_state.basket_counter = {}
+    st.session_state.basket_sum = 0
+    st.session_state.basket_count = 0
 
 
 # ===== 取引の保存 =====
-def save_transaction(basket):
+def save_transaction(counter, count, amount):
     """
-    basket: [300, 300, 200, ...] みたいな価格のリスト
+    counter: {300: 2, 200: 1} みたいな価格ごとの個数
+    count / amount: カゴの合計個数・合計金額
+    保存できたら True を返す
     """
-    if not basket:
+    if not count:
         st.warning("カゴが空です。")
-        return
-
-    ws = get_today_worksheet()
+        return False
 
     now = now_jst()
     ts = now.strftime("%H:%M:%S")
     d = now.date().isoformat()
-    count = len(basket)
-    amount = sum(basket)
-
-    counter = Counter(basket)
-    detail_parts = []
-    for price, cnt in sorted(counter.items()):
-        detail_parts.append(f"{price}円×{cnt}")
-    detail = ", ".join(detail_parts)
 
-    # 1取引＝1行として書き込み
-    ws.append_row([ts, d, count, amount, detail])
-    st.success(f"会計を保存しました：{count}個 / {amount}円")
+    detail = ", ".join(f"{price}円×{counter[price]}" for price in sorted(counter))
+
+    row = [ts, d, count, amount, detail]
+
+    if st.session_state.get("buffered_mode"):
+        # まとめて保存モード：手元にためて、一定件数ごとに書き込む
+        st.session_state.pending_rows.append(row)
+        if len(st.session_state.pending_rows) >= FLUSH_BATCH:
+            flush_pending_rows()
+    else:
+        # 1取引＝1行として書き込み
+        ws = get_today_worksheet()
+        # RAW：サーバー側で値を解釈させない（detail の "=" も文字列のまま）
+        ws.append_row(
+            row, value_input_option="RAW", insert_data_option="INSERT_ROWS"
+        )
+        st.session_state.today_rowcount += 1
+        bump_stats_version()
+    flash("success", f"会計を保存しました：{count}個 / {amount}円")
+    return True
 
 
 # ===== Streamlit UI =====
-def main():
-    st.title("文化祭ポテト会計アプリ 🥔")
-
-    # セッション状態の初期化（カゴ）
-    if "basket" not in st.session_state:
-        st.session_state.basket = []
-    sidebar_today = st.sidebar.container()
-    st.sidebar.markdown("---")
-    sidebar_period = st.sidebar.container()
+@st.fragment
+def basket_panel(discount_password):
+    """
+    カゴまわりの UI。ここでのボタン操作はこの部分だけを再実行し、
+    会計の保存・取り消しのときだけ画面全体（サイドバーの集計）を再実行する
+    """
     # 👇 カゴ表示エリアの「場所」だけ先に確保しておく
     basket_container = st.container()
 
@@ -190,12 +554,12 @@ def main():
     with col_base:
         st.caption("通常価格")
         if st.button(f"ポテト {BASE_PRICE}円 をカゴに追加", key="btn_base"):
-            st.session_state.basket.append(BASE_PRICE)
+            add_to_basket(BASE_PRICE)
 
     with col_seminar:
         st.caption("講演会価格")
         if st.button(f"ポテト {SEMINAR_PRICE}円 をカゴに追加", key="btn_semi"):
-            st.session_state.basket.append(SEMINAR_PRICE)
+            add_to_basket(SEMINAR_PRICE)
 
     # 期間中値下げ価格ボタン
     with col_sale:
@@ -210,12 +574,22 @@ def main():
         )
         if st.button("ポテト（値下げ価格）をカゴに追加", key="btn_sale"):
             # sale_price は number_input の戻り値をそのまま使う
-            st.session_state.basket.append(int(sale_price))
+            add_to_basket(int(sale_price))
 
     # 下段：特別な割引（パスワード制）
     with st.expander("特別な割引で追加（要パスワード）"):
-        pwd = st.text_input("パスワード", type="password", key="pwd_special")
-        if pwd == DISCOUNT_PASSWORD:
+        if not st.session_state.get("discount_unlocked"):
+            pwd = st.text_input("パスワード", type="password", key="pwd_special")
+            # 非 ASCII のパスワードでも比較できるように bytes にする
+            if pwd and hmac.compare_digest(
+                pwd.encode(), str(discount_password).encode()
+            ):
+                # 一度通ればこのセッション中は入力不要
+                st.session_state.discount_unlocked = True
+                st.rerun(scope="fragment")
+            elif pwd != "":
+                st.error("パスワードが違います。")
+        else:
             discount_price = st.number_input(
                 "特別割引の1個あたり価格（円）",
                 min_value=0,
@@ -225,84 +599,121 @@ def main():
                 key="special_discount_price",
             )
             if st.button("特別割引のポテトをカゴに追加", key="btn_special"):
-                st.session_state.basket.append(int(discount_price))
-        elif pwd != "":
-            st.error("パスワードが違います。")
+                add_to_basket(int(discount_price))
 
     # =====================
     # ③ 会計操作
     # =====================
     st.subheader("③ 会計操作")
 
-    col1, col2, col3 = st.columns(3)
+    # 3 つのボタンを 1 つのフォームにまとめ、押されたものだけを処理する
+    with st.form("checkout", clear_on_submit=False, border=False):
+        col1, col2, col3 = st.columns(3)
+        reset = col1.form_submit_button("カゴをリセット")
+        confirm = col2.form_submit_button("会計を確定して保存")
+        cancel = col3.form_submit_button("直前の会計を取り消す")
 
     # カゴをリセット
-    with col1:
-        if st.button("カゴをリセット", key="btn_reset_main"):
-            st.session_state.basket = []
-            st.info("カゴを空にしました。")
+    if reset:
+        reset_basket()
+        st.info("カゴを空にしました。")
 
     # 会計を確定して保存
-    with col2:
-        if st.button("会計を確定して保存", key="btn_confirm_main"):
-            if st.session_state.basket:
-                save_transaction(st.session_state.basket)
-                st.session_state.basket = []  # 会計後にカゴを空にする
-                st.success("会計を保存しました。")
-            else:
-                st.warning("カゴが空です。")
+    elif confirm:
+        if st.session_state.basket_count:
+            if save_transaction(
+                st.session_state.basket_counter,
+                st.session_state.basket_count,
+                st.session_state.basket_sum,
+            ):
+                reset_basket()  # 会計後にカゴを空にする
+                st.rerun()  # サイドバーの集計も更新する
+        else:
+            st.warning("カゴが空です。")
 
     # 直前の会計を取り消す
-    with col3:
-        if st.button("直前の会計を取り消す", key="btn_cancel_main"):
-            cancel_last_transaction()
-            st.info("直前の会計を取り消しました。")
+    elif cancel:
+        if cancel_last_transaction():
+            st.rerun()  # サイドバーの集計も更新する
+
+    show_flash()
 
     # =====================
-    # サイドバーの売上表示（最後に描画）
+    # ① カゴの中身（最後に描画）
     # =====================
+    with basket_container:
+        st.subheader("① カゴの中身")
+
+        if st.session_state.basket_count:
+            counter = st.session_state.basket_counter
+            st.write(
+                " / ".join(f"{price}円 × {counter[price]}個" for price in sorted(counter))
+            )
+            st.write(f"合計個数：**{st.session_state.basket_count} 個**")
+            st.write(f"合計金額：**{st.session_state.basket_sum} 円**")
+        else:
+            st.write("カゴは空です。")
+
+
+def main():
+    st.title("文化祭ポテト会計アプリ 🥔")
+    _, _, discount_password = load_secrets()
+
+    # セッション状態の初期化（カゴ）
+    if "basket_counter" not in st.session_state:
+        reset_basket()
+    if "stats_version" not in st.session_state:
+        st.session_state.stats_version = 0
+    if "pending_rows" not in st.session_state:
+        st.session_state.pending_rows = []
+    sidebar_today = st.sidebar.container()
+    st.sidebar.markdown("---")
+    sidebar_period = st.sidebar.container()
+    st.sidebar.markdown("---")
+    sidebar_sync = st.sidebar.container()
+
+    # =====================
+    # まとめて保存（集計より先に同期しておく）
+    # =====================
+    with sidebar_sync:
+        st.header("まとめて保存")
+        buffered = st.toggle(
+            f"{FLUSH_BATCH}件ごとにまとめて保存", key="buffered_mode"
+        )
+        pending = len(st.session_state.pending_rows)
+        if st.button("同期", key="btn_flush", disabled=pending == 0):
+            st.success(f"{flush_pending_rows()}件をシートに書き込みました。")
+        elif pending and not buffered:
+            # モードを切ったら残りはすぐ書き込む
+            flush_pending_rows()
+        else:
+            st.caption(f"未送信: {pending} 件")
+
+    # =====================
+    # サイドバーの売上表示
+    # =====================
+    if st.sidebar.button("更新", key="btn_refresh_stats"):
+        # 集計キャッシュごと取り直す
+        bump_stats_version()
+    (count, amount), (c3, a3, start, end) = get_sidebar_stats()
+
     with sidebar_today:
         st.header("本日の売上")
-        count, amount = get_today_stats()
         st.metric("売上個数", f"{count} 個")
         st.metric("売上金額", f"{amount} 円")
 
     with sidebar_period:
         st.header("期間中合計")
-        c3, a3, start, end = get_last_n_days_stats(5)
         st.metric("合計個数", f"{c3} 個")
         st.metric("合計金額", f"{a3} 円")
         if start and end:
             st.caption(f"期間: {start} 〜 {end}")
 
     # =====================
-    # ① カゴの中身（最後に描画）
+    # カゴまわり（サイドバーのあとに描画）
     # =====================
-    with basket_container:
-        st.subheader("① カゴの中身")
-
-        if st.session_state.basket:
-            counter = Counter(st.session_state.basket)
-            lines = []
-            for price, cnt in sorted(counter.items()):
-                lines.append(f"{price}円 × {cnt}個")
-            st.write(" / ".join(lines))
-            st.write(f"合計個数：**{len(st.session_state.basket)} 個**")
-            st.write(f"合計金額：**{sum(st.session_state.basket)} 円**")
-        else:
-            st.write("カゴは空です。")
-
-   
+    basket_panel(discount_password)
 
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
-
-
-
-